@@ -2,25 +2,108 @@ from abc import ABCMeta, abstractmethod
 import os
 import re
 import socket
-import traceback
 import signal
 import functools
 import errno
-import fcntl
+import stat
+import select
 import time
 import subprocess
-try:
-    import simplejson as json
-except ImportError:
-    import json
+import sys
+import shlex
+import shutil
+import queue
+import atexit
+import threading
 from importlib import import_module
-from importlib.util import find_spec, module_from_spec
 
 import logging
+import logging.handlers
 from coshsh.util import setup_logging
 
 
 logger = None
+_log_listeners = {}
+_logger_prefix = "eventhandler_"
+_log_format = "%(asctime)s %(process)d - %(levelname)s - %(message)s"
+_hostname = socket.gethostname()
+
+@functools.lru_cache(maxsize=1)
+def _fqdn():
+    # getfqdn() may ask the DNS, do it once for all the runners
+    return socket.getfqdn()
+
+# events of services with such a description are not handled at all
+_ignored_servicedesc = re.compile(r'(Return\ code\ of|Timed\ Out|timed\ out|check_by_ssh:\ Remote\ command|service\ check\ orphaned)')
+# a command line containing one of these needs a shell to be executed
+_shell_syntax = re.compile(r'[|&;<>()$`\\*?\[\]{}~#!\n]|^\s*\w+=')
+# ...and so does one which starts with a shell builtin or keyword
+_shell_builtins = frozenset([
+    ".", ":", "alias", "bg", "break", "case", "cd", "command", "continue",
+    "declare", "do", "done", "elif", "else", "esac", "eval", "exec", "exit",
+    "export", "fc", "fg", "fi", "for", "function", "getopts", "hash", "if",
+    "jobs", "let", "local", "read", "readonly", "return", "select", "set",
+    "shift", "source", "then", "time", "times", "trap", "type", "typeset",
+    "ulimit", "umask", "unalias", "unset", "until", "wait", "while",
+])
+
+def _split_command(command):
+    # returns the argv for a command line which can be spawned without
+    # /bin/sh. None means, let the shell run (or complain about) it.
+    if _shell_syntax.search(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if not argv or argv[0] in _shell_builtins or shutil.which(argv[0]) is None:
+        return None
+    return argv
+
+def start_log_listener(logger):
+    # the handlers created by setup_logging are moved behind a queue.
+    # QueueHandler.prepare() still builds the message (with its %-args) in
+    # the calling thread, but the handlers' formatting (asctime etc.) and
+    # the file write happen in the listener's background thread.
+    handlers = [h for h in logger.handlers]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    # not SimpleQueue, which doesn't exist in python 3.6
+    log_queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _log_listeners[logger.name] = listener
+    return listener
+
+def stop_log_listener(logger_name):
+    # drains the queue, so no record gets lost
+    listener = _log_listeners.pop(logger_name, None)
+    if listener:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+@atexit.register
+def stop_log_listeners():
+    for logger_name in list(_log_listeners):
+        stop_log_listener(logger_name)
+
+@functools.lru_cache(maxsize=256)
+def _camel(name):
+    # keep title(), it also lowercases the rest of a part and capitalizes
+    # after digits. existing runner/decider class names rely on that.
+    return "".join([x.title() for x in name.split("_")])
+
+@functools.lru_cache(maxsize=None)
+def _resolve_runner(target_name):
+    if '.' in target_name:
+        module_name, class_name = target_name.rsplit('.', 1)
+    else:
+        module_name = target_name
+        class_name = _camel(target_name)+"Runner"
+    runner_module = import_module('eventhandler.'+module_name+'.runner', package='eventhandler.'+module_name)
+    return runner_module, getattr(runner_module, class_name)
 
 def new(target_name, tag, decider, verbose, debug, runneropts):
 
@@ -34,7 +117,10 @@ def new(target_name, tag, decider, verbose, debug, runneropts):
         txtloglevel = logging.DEBUG
     else:
         txtloglevel = logging.INFO
-    logger_name = "eventhandler_"+runner_name
+    # interned, so the lookups in logging's logger dict compare by identity
+    logger_name = sys.intern(_logger_prefix+runner_name)
+    # new() can be called multiple times for the same runner (unittests)
+    stop_log_listener(logger_name)
 
     if "logfile_backups" in runneropts:
         backup_count = int(runneropts["logfile_backups"])
@@ -44,16 +130,34 @@ def new(target_name, tag, decider, verbose, debug, runneropts):
     else:
         backup_count = 3
 
-    setup_logging(logdir=os.environ["OMD_ROOT"]+"/var/log", logfile=logger_name+".log", scrnloglevel=scrnloglevel, txtloglevel=txtloglevel, format="%(asctime)s %(process)d - %(levelname)s - %(message)s", backup_count=backup_count)
+    if "nonblocking_log" in runneropts:
+        nonblocking_log = str(runneropts["nonblocking_log"]).lower() in ["1", "yes", "true", "on"]
+        del runneropts["nonblocking_log"]
+    else:
+        nonblocking_log = False
+
+    setup_logging(logdir=os.environ["OMD_ROOT"]+"/var/log", logfile=logger_name+".log", scrnloglevel=scrnloglevel, txtloglevel=txtloglevel, format=_log_format, backup_count=backup_count)
     logger = logging.getLogger(logger_name)
-    try:
-        if '.' in target_name:
-            module_name, class_name = target_name.rsplit('.', 1)
+    # setup_logging leaves the logger at DEBUG. lower it to what the handlers
+    # accept, so isEnabledFor() can really skip records nobody will write.
+    logger.setLevel(min(scrnloglevel, txtloglevel))
+    if nonblocking_log:
+        # the logfile is written by a sidecar process which reads the fifo.
+        # if it can't keep up, log lines are dropped instead of stalling us.
+        try:
+            fifo_handler = NonBlockingFifoHandler(os.environ["OMD_ROOT"]+"/tmp/run/"+logger_name+".fifo")
+        except Exception as e:
+            logger.critical("can not log to a fifo, keep the logfile: %s", e)
         else:
-            module_name = target_name
-            class_name = "".join([x.title() for x in target_name.split("_")])+"Runner"
-        runner_module = import_module('eventhandler.'+module_name+'.runner', package='eventhandler.'+module_name)
-        runner_class = getattr(runner_module, class_name)
+            for handler in [h for h in logger.handlers if isinstance(h, logging.FileHandler)]:
+                handler.close()
+                logger.removeHandler(handler)
+            fifo_handler.setFormatter(logging.Formatter(_log_format))
+            fifo_handler.setLevel(txtloglevel)
+            logger.addHandler(fifo_handler)
+    log_listener = start_log_listener(logger)
+    try:
+        runner_module, runner_class = _resolve_runner(target_name)
 
         instance = runner_class(runneropts)
         instance.__module_file__ = runner_module.__file__
@@ -61,12 +165,17 @@ def new(target_name, tag, decider, verbose, debug, runneropts):
         if tag:
             instance.tag = tag
         instance.runner_name = runner_name
+        # runner_name without the "_"+tag suffix, which is the target_name
+        instance._runner_name_no_tag = target_name
         instance.decider_name = decider
+        instance._logger_name = logger_name
+        instance._log_listener = log_listener
 
         # so we can use logger.info(...) in the single modules
         runner_module.logger = logging.getLogger(logger_name)
         base_module = import_module('.baseclass', package='eventhandler')
         base_module.logger = logging.getLogger(logger_name)
+        instance._log_enabled_debug = logger.isEnabledFor(logging.DEBUG)
 
     except Exception as e:
         raise ImportError('{} is not part of our runner collection!'.format(target_name))
@@ -76,24 +185,82 @@ def new(target_name, tag, decider, verbose, debug, runneropts):
 
     return instance
 
+class NonBlockingFifoHandler(logging.Handler):
+    """Writes log lines to a named pipe without ever blocking.
+    If there is no reader or the reader can't keep up, the line is dropped
+    and counted in self.dropped. Lines longer than PIPE_BUF are cut and
+    counted in self.truncated, because only writes up to PIPE_BUF are
+    atomic. A longer write could leave a fragment in the pipe."""
+
+    def __init__(self, path):
+        super(NonBlockingFifoHandler, self).__init__()
+        self.path = path
+        self.fd = None
+        self.dropped = 0
+        self.truncated = 0
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), 0o755, exist_ok=True)
+            os.mkfifo(path, 0o600)
+        elif not stat.S_ISFIFO(os.stat(path).st_mode):
+            raise ValueError("{} exists and is not a fifo".format(path))
+
+    def emit(self, record):
+        try:
+            msg = (self.format(record)+"\n").encode("utf-8", "replace")
+            if len(msg) > select.PIPE_BUF:
+                # cut at a character boundary and terminate the line
+                msg = msg[:select.PIPE_BUF-1].decode("utf-8", "ignore").encode("utf-8")+b"\n"
+                self.truncated += 1
+            if self.fd is None:
+                # raises ENXIO as long as nobody reads the fifo
+                self.fd = os.open(self.path, os.O_WRONLY|os.O_NONBLOCK)
+            os.write(self.fd, msg)
+        except BlockingIOError:
+            self.dropped += 1
+        except OSError as e:
+            if e.errno not in [errno.ENXIO, errno.EPIPE]:
+                self.handleError(record)
+            if self.fd is not None and e.errno == errno.EPIPE:
+                # the reader went away, reopen with the next record
+                os.close(self.fd)
+                self.fd = None
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+        finally:
+            self.release()
+        super(NonBlockingFifoHandler, self).close()
+
+
 class RunnerTimeoutError(Exception):
     pass
 
 def timeout(seconds, error_message="Timeout"):
     def decorator(func):
+        def handler(signum, frame):
+            raise RunnerTimeoutError(error_message)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            def handler(signum, frame):
-                raise RunnerTimeoutError(error_message)
-
-            original_handler = signal.signal(signal.SIGALRM, handler)
-            signal.alarm(seconds)
+            # the alarm would interrupt the main thread, not the caller
+            if threading.current_thread() is not threading.main_thread():
+                raise ValueError("signal only works in main thread")
+            # the handler is installed with the first call and then stays
+            # until another decorated function is called.
+            if signal.getsignal(signal.SIGALRM) is not handler:
+                signal.signal(signal.SIGALRM, handler)
+            signal.setitimer(signal.ITIMER_REAL, seconds)
             try:
-                result = func(*args, **kwargs)
+                return func(*args, **kwargs)
             finally:
-                signal.signal(signal.SIGALRM, original_handler)
-                signal.alarm(0)
-            return result
+                signal.setitimer(signal.ITIMER_REAL, 0)
         return wrapper
     return decorator
 
@@ -104,16 +271,23 @@ class EventhandlerPythonRunner(object):
 class EventhandlerRunner(object):
     """This is the base class where all Runners inherit from"""
     __metaclass__ = ABCMeta # replace with ...BaseClass(metaclass=ABCMeta):
+    _command_results = None
 
     def __init__(self, opts):
         self.baseclass_logs_summary = True
-        for opt in opts:
-            setattr(self, opt, opts[opt])
+        # new() sets it, once the runner's logger is known
+        self._log_enabled_debug = False
+        # these don't change during the lifetime of a runner
+        self._hostname = _hostname
+        self._fqdn = _fqdn()
+        self._omd_site = os.environ.get("OMD_SITE", "get https://omd.consol.de/docs/omd")
+        self._decider_instance = None
+        self.__dict__.update(opts)
 
     def new_decider(self):
         try:
             module_name = self.decider_name
-            class_name = "".join([x.title() for x in self.decider_name.split("_")])+"Decider"
+            class_name = _camel(self.decider_name)+"Decider"
             decider_module = import_module('.decider', package='eventhandler.'+module_name)
             decider_module.logger = logger
             decider_class = getattr(decider_module, class_name)
@@ -121,53 +295,57 @@ class EventhandlerRunner(object):
             instance.__module_file__ = decider_module.__file__
             return instance
         except ImportError:
-            logger.critical("found no decider module {}".format(module_name))
+            logger.critical("found no decider module %s", module_name)
             return None
         except Exception as e:
-            logger.critical("unknown error error in decider instantiation: {}".format(e))
+            logger.critical("unknown error error in decider instantiation: %s", e)
             return None
 
 
+    def get_decider(self):
+        # deciders are stateless, one instance serves all the events
+        if self._decider_instance is None:
+            self._decider_instance = self.new_decider()
+        return self._decider_instance
+
     def decide_and_prepare_event(self, raw_event):
-        instance = self.new_decider()
+        instance = self.get_decider()
         if not "omd_site" in raw_event:
-            raw_event["omd_site"] = os.environ.get("OMD_SITE", "get https://omd.consol.de/docs/omd")
-        raw_event["omd_originating_host"] = socket.gethostname()
-        raw_event["omd_originating_fqdn"] = socket.getfqdn()
-        raw_event["omd_originating_timestamp"] = int(time.time())
+            raw_event["omd_site"] = self._omd_site
+        raw_event["omd_originating_host"] = self._hostname
+        raw_event["omd_originating_fqdn"] = self._fqdn
         raw_event["omd_originating_timestamp"] = int(time.time())
         try:
             decided_event = DecidedEvent(raw_event)
-            setattr(instance, "runner", self.runner_name[:-len("_"+self.tag)] if hasattr(self, "tag") and self.runner_name.endswith("_"+self.tag) else self.runner_name)
+            setattr(instance, "runner", self._runner_name_no_tag)
             instance.decide_and_prepare(decided_event)
             return decided_event
         except Exception as e:
-            logger.critical("when deciding based on this {} with this {} there was an error <{}>".format(str(raw_event), instance.__class__.__name__+"@"+instance.__module_file__, str(e)))
+            logger.critical("when deciding based on this %s with this %s@%s there was an error <%s>", raw_event, instance.__class__.__name__, instance.__module_file__, e)
             return None
 
     def handle(self, raw_event):
         success = False
         if "SERVICEDESC" in raw_event:
-            if re.match(r'(Return\ code\ of|Timed\ Out|timed\ out|check_by_ssh:\ Remote\ command|service\ check\ orphaned)', raw_event["SERVICEDESC"]):
+            if _ignored_servicedesc.match(raw_event["SERVICEDESC"]):
                 return True
         try:
             decided_event = self.decide_and_prepare_event(raw_event)
-            if decided_event.is_discarded:
-                if not decided_event.is_discarded_silently:
-                    if not decided_event.summary:
-                        decided_event.summary = str(raw_event)
-                    logger.info("discarded: {}".format(decided_event.summary))
-                decided_event = None
-            elif decided_event and not decided_event.is_complete():
-                logger.critical("a decided event {} must have the attributes payload and summary. {}".format(decided_event.__class__.__name__, decided_event.__dict__))
-                decided_event = None
         except Exception as e:
-            try:
-                decided_event
-            except NameError:
-                logger.critical("raw event {} caused error {}".format(str(raw_event), str(e)))
+            logger.critical("raw event %s caused error %s", raw_event, e)
+            return None
+        if decided_event is None:
+            # decide_and_prepare_event has already logged the error
+            return None
+        if decided_event.is_discarded:
+            if not decided_event.is_discarded_silently:
+                if not decided_event.summary:
+                    decided_event.summary = str(raw_event)
+                logger.info("discarded: %s", decided_event.summary)
+            decided_event = None
+        elif not decided_event.is_complete():
+            logger.critical("a decided event %s must have the attributes payload and summary. payload %s, summary %s", decided_event.__class__.__name__, decided_event.payload, decided_event.summary)
             decided_event = None
-            success = None
         if decided_event:
             self.overwrite_attributes(decided_event.payload)
             success, stdout, stderr = self.run_decided(decided_event)
@@ -191,11 +369,29 @@ class EventhandlerRunner(object):
                     self.forwarder.forward(raw_event)
         return success
 
+    def handle_batch(self, raw_events):
+        """Handles a list of events and returns a list of their results.
+        If several events lead to the same command line, the command is
+        executed only once and its result is used for all of them."""
+        # the payload of an event overwrites runner attributes (and a runner
+        # may call no_more_logging()), so every event starts again with
+        # the attributes the runner had before the batch.
+        runner_attributes = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        results = []
+        self._command_results = {}
+        try:
+            for raw_event in raw_events:
+                results.append(self.handle(raw_event))
+                self.__dict__.update(runner_attributes)
+        finally:
+            self._command_results = None
+        return results
+
     def overwrite_attributes(self, payload):
-        # paload can overwrite runneropts
-        for k in payload:
-            if hasattr(self, k):
-                setattr(self, k, payload[k])
+        # paload can overwrite runneropts (which are public instance
+        # attributes, methods, class attributes and the runner's internal
+        # _attributes are left alone)
+        self.__dict__.update({k: payload[k] for k in payload.keys() & self.__dict__.keys() if not k.startswith("_")})
 
     def run_decided(self, decided_event):
         decide_exception_msg = None
@@ -205,13 +401,22 @@ class EventhandlerRunner(object):
                 success = True
             else:
                 runner_res = self.run(decided_event)
-                if isinstance(runner_res, str):
-                    # The runner returns a command line
+                if isinstance(runner_res, (str, list)):
+                    # The runner returns a command line or, preferably, an
+                    # argv list. Command lines with redirections, pipes,
+                    # variables etc., shell builtins or commands which are
+                    # not found in PATH are handed to /bin/sh, everything
+                    # else is spawned directly.
                     command = runner_res
-                    logger.debug(f"command is {command}")
-                    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    stdout, stderr = proc.communicate()
-                    exit_code = proc.wait()
+                    # _command_results only exists during handle_batch
+                    command_results = self._command_results
+                    command_key = command if isinstance(command, str) else tuple(command)
+                    if command_results is not None and command_key in command_results:
+                        exit_code, stdout, stderr = command_results[command_key]
+                    else:
+                        exit_code, stdout, stderr = self.run_command(command)
+                        if command_results is not None:
+                            command_results[command_key] = (exit_code, stdout, stderr)
                     success = True if exit_code == 0 else False
                 elif runner_res in [True, False]:
                     # The runner is pure python or executed a command itself or
@@ -230,19 +435,32 @@ class EventhandlerRunner(object):
 
         if success:
             if self.baseclass_logs_summary:
-                logger.info("{}".format(decided_event.summary))
-                logger.debug("stdout {}, stderr {}".format(stdout if stdout else "", stderr if stderr else ""))
+                logger.info("%s", decided_event.summary)
+                if self._log_enabled_debug:
+                    logger.debug("stdout %s, stderr %s", stdout or "", stderr or "")
             return True, stdout, stderr
         else:
             if stderr:
-                logger.critical("run failed: stdout {}, stderr {}, event {}".format(stdout if stdout else "", stderr if stderr else "", decided_event.summary))
+                logger.critical("run failed: stdout %s, stderr %s, event %s", stdout or "", stderr, decided_event.summary)
             elif decide_exception_msg:
-                logger.critical("run failed: exception <{}>, event was <{}>".format(decide_exception_msg, decided_event.summary))
+                logger.critical("run failed: exception <%s>, event was <%s>", decide_exception_msg, decided_event.summary)
             elif self.baseclass_logs_summary:
-                logger.critical("run failed: stdout {}, stderr {}, exitcode {}, event {}".format(stdout if stdout else "", stderr if stderr else "", exit_code, decided_event.summary))
+                logger.critical("run failed: stdout %s, stderr %s, exitcode %s, event %s", stdout or "", stderr or "", exit_code, decided_event.summary)
             return False, stdout, stderr
 
 
+    def run_command(self, command):
+        if self._log_enabled_debug:
+            logger.debug("command is %s", command)
+        # stdout is always captured. plugins and remote commands explain a
+        # failure there, and a failure is only known after the command ran.
+        argv = command if isinstance(command, list) else _split_command(command)
+        if argv is None:
+            proc = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        else:
+            proc = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        return proc.returncode, proc.stdout, proc.stderr
+
     def no_more_logging(self):
         # this is called in the runner. If the runner already wrote
         # it's own logs and writing the summary by the baseclass is not
@@ -255,25 +473,26 @@ class EventhandlerRunner(object):
     def disconnect(self):
         return True
 
-    def __del__(self):
-        try:
-            pass
-        except Exception as a:
-            # don't care, we're finished anyway
-            pass
-    
+
 class EventhandlerDecider(metaclass=ABCMeta):
+    # set by the runner. deciders which don't declare __slots__ themselves
+    # still get a __dict__ for their own attributes.
+    __slots__ = ("runner", "__module_file__")
+
     @abstractmethod
     def decide_and_prepare(self):
         pass
 
 
-class DecidedEvent(metaclass=ABCMeta):
+class DecidedEvent(object):
+    __slots__ = ("_eventopts", "_payload", "_summary", "_runneropts", "_discarded", "_discarded_silently", "_is_heartbeat")
+
     def __init__(self, eventopts):
         self._eventopts = eventopts
-        for k in self._eventopts:
-            if isinstance(self._eventopts[k], str) and self._eventopts[k].isdigit():
-                self._eventopts[k] = int(self._eventopts[k])
+        # the first character rejects most non-numeric strings cheaply
+        numeric = [(k, int(v)) for k, v in eventopts.items() if type(v) is str and v and v[0].isdigit() and v.isdigit()]
+        for k, v in numeric:
+            eventopts[k] = v
         self._payload = None
         self._summary = str(self._eventopts)
         self._runneropts = {}
@@ -328,12 +547,7 @@ class DecidedEvent(metaclass=ABCMeta):
     @property
     def is_discarded(self):
         return self._discarded
-        
-    def is_complete(self): 
-        if self._payload == None or self._summary == None:
-            return False
-        return True
-        
+
     def discard(self, silently=True):
         self._discarded = True
         self._discarded_silently = True if silently else False
@@ -7,6 +7,9 @@ import shutil
 import hashlib, secrets
 import eventhandler.baseclass
 import logging
+import logging.handlers
+import select
+import threading
 os.environ['PYTHONDONTWRITEBYTECODE'] = "true"
 
 
@@ -39,9 +42,10 @@ def setup():
     yield
 
 def get_logfile(runner):
-    logger_name = "eventhandler_"+runner.name
-    logger = logging.getLogger(logger_name)
-    return [h.baseFilename for h in logger.handlers if hasattr(h, "baseFilename")][0]
+    # records are written by the listener thread, drain the queue first
+    runner._log_listener.stop()
+    runner._log_listener.start()
+    return [h.baseFilename for h in runner._log_listener.handlers if hasattr(h, "baseFilename")][0]
 
 
 def test_example_runner(setup):
@@ -58,6 +62,12 @@ def test_example_decider(setup):
     example = eventhandler.baseclass.new("example", None, "example", True, True,  {})
     dexample = example.new_decider()
     assert dexample.__class__.__name__ == "ExampleDecider"
+    assert example.get_decider().__class__.__name__ == "ExampleDecider"
+    assert example.get_decider() is example.get_decider()
+    decider = example.get_decider()
+    example.overwrite_attributes({"_decider_instance": "x", "run": "x", "path": "/tmp"})
+    assert example.get_decider() is decider
+    assert callable(example.run)
 
 
 def test_example_logging(setup):
@@ -66,8 +76,10 @@ def test_example_logging(setup):
     logger = logging.getLogger(logger_name)
     assert logger != None
     assert logger.name == "eventhandler_example"
-    assert len([h for h in logger.handlers]) == 2
-    logfile = [h.baseFilename for h in logger.handlers if hasattr(h, "baseFilename")][0]
+    assert len([h for h in logger.handlers]) == 1
+    assert isinstance(logger.handlers[0], logging.handlers.QueueHandler)
+    assert len(example._log_listener.handlers) == 2
+    logfile = get_logfile(example)
     assert logfile.endswith("eventhandler_example.log")
 
     example = eventhandler.baseclass.new("example", "2", "example", True, True,  {})
@@ -75,8 +87,9 @@ def test_example_logging(setup):
     logger = logging.getLogger(logger_name)
     assert logger != None
     assert logger.name == "eventhandler_example_2"
-    assert len(logger.handlers) == 2
-    logfile = [h.baseFilename for h in logger.handlers if hasattr(h, "baseFilename")][0]
+    assert len(logger.handlers) == 1
+    assert len(example._log_listener.handlers) == 2
+    logfile = get_logfile(example)
     assert logfile.endswith("eventhandler_example_2.log")
     
 
@@ -91,6 +104,7 @@ def test_example_decider_prepare_event(setup):
     }
     event = eventhandler.baseclass.DecidedEvent(raw_event)
     assert event.eventopts["content"] == "halo i bims 1 alarm vong naemon her"
+    assert not hasattr(event, "__dict__")
     dexample.decide_and_prepare(event)
     assert event.summary == "summary is samari"+sig
     assert event.payload["content"] == "halo i bims 1 alarm vong naemon her"
@@ -113,6 +127,48 @@ def test_example_runner_run_nodiscard_nosummary(setup):
     assert "halo i bims 1 alarm vong naemon her" in echo
     assert sig in echo
 
+def test_example_runner_handle_batch(setup):
+    runneropts = { "path": "/tmp", }
+    example = eventhandler.baseclass.new("example", None, "example", True, True,  runneropts)
+    commands = []
+    run_command = example.run_command
+    def counting_run_command(command):
+        commands.append(command)
+        return run_command(command)
+    example.run_command = counting_run_command
+    results = example.handle_batch([
+        { "summary": "sammari1", "content": "halo i bims 1 alarm vong naemon her", },
+        { "summary": "sammari2", "content": "halo i bims 1 alarm vong naemon her", },
+        { "summary": "sammari3", "content": "halo i bims 1 anderer alarm", },
+        { "summary": "sammari4", "content": "halo i bims 1 alarm vong naemon her", "discard": False, },
+    ])
+    assert results == [True, True, True, False]
+    assert len(commands) == 2
+    log = open(get_logfile(example)).read()
+    assert "INFO - summary is sammari1" in log
+    assert "INFO - summary is sammari2" in log
+    assert "INFO - summary is sammari3" in log
+    assert "discarded: halo i bims 1 alarm vong naemon her und i schmeis" in log
+    echo = open("/tmp/echo").read()
+    assert "halo i bims 1 anderer alarm" in echo
+
+def test_example_runner_handle_batch_payload_does_not_leak(setup):
+    example = eventhandler.baseclass.new("example", None, "example", True, True,  {})
+    delays = []
+    run = example.run
+    def recording_run(event):
+        delays.append(example.delay)
+        return run(event)
+    example.run = recording_run
+    results = example.handle_batch([
+        { "summary": "sammari1", "content": "halo i bims 1 alarm", "delay": 0.01, },
+        { "summary": "sammari2", "content": "halo i bims 1 anderer alarm", },
+    ])
+    assert results == [True, True]
+    assert delays == [0.01, None]
+    assert example.delay == None
+    assert example._command_results == None
+
 def test_example_runner_run_discard_loud(setup):
     runneropts = { "path": "/tmp", }
     _setup() # delete logfile
@@ -154,3 +210,105 @@ def test_example_runner_timeout(setup):
     example.handle(eventopts)
     assert not os.path.exists("/tmp/echo") # discard -> no runner
 
+
+def test_example_nonblocking_log(setup):
+    runneropts = { "path": "/tmp", "nonblocking_log": "yes" }
+    eventopts = {
+        "summary": "i bim dem sammari",
+        "content": "halo i bims 1 alarm vong naemon her",
+    }
+    fifo = omd_root+"/tmp/run/eventhandler_example.fifo"
+    example = eventhandler.baseclass.new("example", None, "example", True, True,  runneropts)
+    assert not hasattr(example, "nonblocking_log")
+    assert not [h for h in example._log_listener.handlers if hasattr(h, "baseFilename")]
+    fifo_handler = [h for h in example._log_listener.handlers if isinstance(h, eventhandler.baseclass.NonBlockingFifoHandler)][0]
+    # nobody reads the fifo, the log line is dropped
+    example.handle(dict(eventopts))
+    example._log_listener.stop()
+    example._log_listener.start()
+    assert fifo_handler.dropped > 0
+    dropped = fifo_handler.dropped
+    reader = os.open(fifo, os.O_RDONLY|os.O_NONBLOCK)
+    try:
+        example.handle(dict(eventopts))
+        example._log_listener.stop()
+        example._log_listener.start()
+        assert fifo_handler.dropped == dropped
+        log = os.read(reader, 65536).decode()
+        assert "INFO - summary is i bim dem sammari" in log
+        # a record longer than PIPE_BUF is cut, the next one is intact
+        example.handle(dict(eventopts, summary="x"*60000))
+        example.handle(dict(eventopts))
+        example._log_listener.stop()
+        example._log_listener.start()
+        assert fifo_handler.truncated == 1
+        lines = os.read(reader, 65536).decode().splitlines()
+        assert max([len(l) for l in lines]) < select.PIPE_BUF
+        assert [l for l in lines if l.endswith("INFO - summary is i bim dem sammari")]
+        assert all([re.match(r'\d{4}-\d\d-\d\d ', l) for l in lines])
+    finally:
+        os.close(reader)
+
+def test_timeout_decorator():
+    @eventhandler.baseclass.timeout(1, error_message="i bim z langsam")
+    def slow():
+        time.sleep(5)
+        return True
+    @eventhandler.baseclass.timeout(1)
+    def fast():
+        return True
+    tic = time.time()
+    with pytest.raises(eventhandler.baseclass.RunnerTimeoutError, match="i bim z langsam"):
+        slow()
+    assert time.time() - tic < 3
+    assert fast() == True
+    # the timer must be disarmed after the call
+    time.sleep(1.5)
+    # a timer armed from another thread would hit the main thread
+    errors = []
+    def call_fast():
+        try:
+            fast()
+        except Exception as e:
+            errors.append(e)
+    worker = threading.Thread(target=call_fast)
+    worker.start()
+    worker.join()
+    assert isinstance(errors[0], ValueError)
+
+def test_example_runner_run_command_output(setup):
+    example = eventhandler.baseclass.new("example", None, "example", False, False,  {})
+    exit_code, stdout, stderr = example.run_command("echo halo; echo i bims >&2")
+    assert exit_code == 0
+    assert stdout == b"halo\n"
+    assert stderr == b"i bims\n"
+    example = eventhandler.baseclass.new("example", None, "example", True, True,  {})
+    exit_code, stdout, stderr = example.run_command(["echo", "halo"])
+    assert exit_code == 0
+    assert stdout == b"halo\n"
+    # builtins and unknown commands are left to the shell
+    assert example.run_command("exit 0")[0] == 0
+    assert example.run_command("cd /tmp")[0] == 0
+    exit_code, stdout, stderr = example.run_command("i_bims_1_unbekanntes_kommando")
+    assert exit_code == 127
+    assert b"not found" in stderr
+
+def test_fifo_handler_refuses_plain_file(setup):
+    path = omd_root+"/tmp/run/eventhandler_example.fifo"
+    os.makedirs(os.path.dirname(path))
+    open(path, "w").close()
+    with pytest.raises(ValueError):
+        eventhandler.baseclass.NonBlockingFifoHandler(path)
+    example = eventhandler.baseclass.new("example", None, "example", True, True,  { "nonblocking_log": "yes" })
+    assert get_logfile(example).endswith("eventhandler_example.log")
+
+def test_example_runner_run_failed_stdout(setup):
+    example = eventhandler.baseclass.new("example", None, "example", False, False,  {})
+    example.run = lambda event: "sh -c 'echo CRITICAL - service down; exit 2'"
+    success = example.handle({
+        "summary": "i bim dem sammari",
+        "content": "halo i bims 1 alarm vong naemon her",
+    })
+    assert success == False
+    log = open(get_logfile(example)).read()
+    assert "CRITICAL - run failed: stdout b'CRITICAL - service down\\n', stderr , exitcode 2" in log